@@ -1,17 +1,45 @@
 import os
+import atexit
 import base64
+import functools
 import json
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import FailedPrecondition, GoogleAPICallError
 from google.cloud.firestore_v1._helpers import GeoPoint
-import requests
+import httpx
+import numpy as np
+import orjson
+import pygeohash as pgh
+from pydantic import BaseModel, Field, ValidationError
+from cachetools import TTLCache
+
+from polyline_decoder import decode_polyline
+
+# Native nearest-neighbour queries need a google-cloud-firestore with vector search
+try:
+    from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+    from google.cloud.firestore_v1.vector import Vector
+    FIND_NEAREST_SUPPORTED = hasattr(firestore.Query, 'find_nearest')
+except ImportError:
+    FIND_NEAREST_SUPPORTED = False
 
 # 1. Load environment variables
 FIREBASE_KEY_BASE64 = os.environ.get("FIREBASE_KEY_BASE64")
 GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
+# Opt in once ambulance docs carry 'geohash' and the status + geohash
+# composite index exists; until then every search is a full scan
+USE_GEOHASH_QUERIES = os.environ.get("USE_GEOHASH_QUERIES", "").lower() in ("1", "true")
+# Opt in once every ambulance doc carries 'location_vector' and its vector
+# index exists (see FIND_NEAREST_LIMIT)
+USE_FIND_NEAREST = os.environ.get("USE_FIND_NEAREST", "").lower() in ("1", "true")
 
 if not FIREBASE_KEY_BASE64:
     raise Exception("FIREBASE_KEY_BASE64 environment variable not set!")
@@ -28,7 +56,141 @@ try:
 except Exception as e:
     raise Exception(f"Failed to initialize Firebase Admin: {str(e)}")
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serve JSON with orjson; numpy arrays are serialized natively"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def response(self, *args, **kwargs):
+        # jsonify() body: hand orjson's bytes to the response without a str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+            mimetype=self.mimetype
+        )
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Compress JSON responses (mainly /fetch-route polylines) for mobile clients
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_LEVEL'] = 5
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)
+
+# Pooled HTTP/2 client shared by all Google Maps calls; concurrent requests
+# from the executor are multiplexed over the same TLS connection
+CLIENT = httpx.Client(
+    timeout=10.0,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        retries=2
+    )
+)
+atexit.register(CLIENT.close)
+
+# Distance Matrix accepts at most 25 destinations per request (single origin)
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+
+# Number of straight-line nearest ambulances to rank by driving distance
+DRIVING_DISTANCE_CANDIDATES = 5
+
+# Ambulance docs carry a 'geohash' of their current_location (written by the
+# driver app, precision 7 / ~150 m). Searches range-query the user's cell and
+# its 8 neighbours at a coarser prefix length (~5 km cells).
+GEOHASH_SEARCH_PRECISION = 5
+
+# With USE_FIND_NEAREST set (and SDK support), Firestore's vector index returns
+# the FIND_NEAREST_LIMIT closest available ambulances and the Haversine step
+# re-ranks them (raw lat/lng Euclidean distance is only approximate away from
+# the equator). This needs:
+#   - 'location_vector' on every ambulance doc: a Vector([lat, lng]) copy of
+#     current_location, kept in sync by whatever writes positions. This server
+#     never writes it. Docs without it (or with a stale one) are invisible to
+#     the query, and a single hit skips the fallback paths.
+#   - a composite vector index on ambulances: status (ascending) +
+#     location_vector (vector, dimension 2, flat).
+FIND_NEAREST_LIMIT = 20
+find_nearest_enabled = USE_FIND_NEAREST and FIND_NEAREST_SUPPORTED
+
+# The only ambulance fields the nearest-ambulance lookup reads
+AMBULANCE_FIELDS = ['ambulance_id', 'current_location', 'driver_name', 'contact_number', 'status']
+
+# Shared pool for blocking I/O fanned out by request threads (Firestore cell
+# queries, Google Maps batches)
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Short-lived cache of Distance Matrix results, keyed on coordinates rounded
+# to 4 decimal places (~11 m) so ambulances that haven't moved are not re-queried
+DISTANCE_CACHE = TTLCache(maxsize=50_000, ttl=300)
+DISTANCE_CACHE_LOCK = threading.Lock()
+
+
+# Request bodies, validated straight from the raw JSON by pydantic-core
+class GeocodeRequest(BaseModel):
+    address: str
+
+
+class LocationIn(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+
+class NearestAmbulanceRequest(BaseModel):
+    location: LocationIn
+
+
+class RouteRequest(BaseModel):
+    ambulance_id: str = Field(min_length=1)
+    user_lat: float = Field(ge=-90, le=90)
+    user_lng: float = Field(ge=-180, le=180)
+
+
+def parse_maps_response(response):
+    """Decode a Google Maps JSON body with orjson; None for non-200 or non-JSON responses"""
+    if response.status_code != 200:
+        return None
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return None
+
+
+class GeocodingError(Exception):
+    """Geocoding failed; carries the HTTP status to report to the client"""
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@functools.lru_cache(maxsize=10000)
+def geocode(address):
+    """
+    Resolve a normalized address to (lat, lng) via the Geocoding API.
+    Successful lookups are cached in-process; failures raise and are not cached.
+    """
+    url = "https://maps.googleapis.com/maps/api/geocode/json"
+    params = {
+        "address": address,
+        "key": GOOGLE_MAPS_API_KEY
+    }
+
+    response = CLIENT.get(url, params=params)
+    response_data = parse_maps_response(response)
+
+    if response_data is None:
+        raise GeocodingError(f"Failed to fetch geocoding data. Status code: {response.status_code}", 500)
+    if response_data.get('status') != 'OK':
+        # e.g. "ZERO_RESULTS", "REQUEST_DENIED", etc.
+        err = response_data.get('status')
+        raise GeocodingError(f"Geocoding API error: {err}", 400)
+
+    location = response_data['results'][0]['geometry']['location']
+    return float(location['lat']), float(location['lng'])
+
 
 # -------------------------------------------------------------------
 # (Optional) Endpoint: Geocode an address on the server
@@ -36,32 +198,17 @@ app = Flask(__name__)
 @app.route('/geocode-address', methods=['POST'])
 def geocode_address():
     try:
-        data = request.json
-        if not data or 'address' not in data:
+        try:
+            req = GeocodeRequest.model_validate_json(request.get_data())
+        except ValidationError:
             return jsonify({"error": "Address not provided"}), 400
 
-        address = data['address']
-        url = "https://maps.googleapis.com/maps/api/geocode/json"
-        params = {
-            "address": address,
-            "key": GOOGLE_MAPS_API_KEY
-        }
-
-        response = requests.get(url, params=params)
-        response_data = response.json()
+        try:
+            lat, lng = geocode(req.address.strip().lower())
+        except GeocodingError as e:
+            return jsonify({"error": str(e)}), e.status_code
 
-        if response.status_code == 200:
-            if response_data.get('status') == 'OK':
-                location = response_data['results'][0]['geometry']['location']
-                lat = float(location['lat'])
-                lng = float(location['lng'])
-                return jsonify({"latitude": lat, "longitude": lng}), 200
-            else:
-                # e.g. "ZERO_RESULTS", "REQUEST_DENIED", etc.
-                err = response_data.get('status')
-                return jsonify({"error": f"Geocoding API error: {err}"}), 400
-        else:
-            return jsonify({"error": f"Failed to fetch geocoding data. Status code: {response.status_code}"}), 500
+        return jsonify({"latitude": lat, "longitude": lng}), 200
 
     except Exception as e:
         app.logger.error(f"Error in /geocode-address: {str(e)}\n{traceback.format_exc()}")
@@ -80,69 +227,67 @@ def get_nearest_ambulance():
     Returns nearest ambulance data.
     """
     try:
-        user_location = request.json.get("location")
-        if not user_location:
+        try:
+            req = NearestAmbulanceRequest.model_validate_json(request.get_data())
+        except ValidationError:
             return jsonify({"error": "Location not provided"}), 400
 
-        user_lat = user_location['latitude']
-        user_lng = user_location['longitude']
-
-        # Fetch only ambulances with status == 'available'
-        ambulances_ref = db.collection('ambulances').where('status', '==', 'available')
-        ambulances = ambulances_ref.stream()
-
-        ambulance_data = []
-        for amb in ambulances:
-            amb_dict = amb.to_dict()
-            current_location = amb_dict.get('current_location')
-
-            # If stored as a GeoPoint, convert to lat/lng
-            if isinstance(current_location, GeoPoint):
-                ambulance_data.append({
-                    "id": amb_dict.get('ambulance_id', 'Not available'),
-                    "latitude": current_location.latitude,
-                    "longitude": current_location.longitude,
-                    "name": amb_dict.get('driver_name', 'Ambulance'),
-                    "contact": amb_dict.get('contact_number', 'Not provided'),
-                    "status": amb_dict.get('status', 'Not available')
-                })
-            else:
-                app.logger.warning(f"Ambulance {amb.id} has invalid location data")
+        user_lat = req.location.latitude
+        user_lng = req.location.longitude
+
+        # Fetch only ambulances with status == 'available' around the user
+        ambulance_data = fetch_available_ambulances(user_lat, user_lng)
 
         # Use Google Distance Matrix to find the nearest
         min_distance = float('inf')
         nearest_ambulance = None
         nearest_ambulance_time = None
 
-        for ambulance in ambulance_data:
-            # Distance Matrix
-            url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-            params = {
-                "origins": f"{user_lat},{user_lng}",
-                "destinations": f"{ambulance['latitude']},{ambulance['longitude']}",
-                "key": GOOGLE_MAPS_API_KEY,
-                "mode": "driving",
-                "departure_time": "now"
-            }
-
-            response = requests.get(url, params=params)
-            data = response.json()
-
-            if data.get('status') == 'OK' and data['rows']:
-                elements = data['rows'][0]['elements'][0]
-                if elements['status'] == 'OK':
-                    distance = elements['distance']['value']  # meters
-                    duration = elements['duration']['text']
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_ambulance = ambulance
-                        nearest_ambulance_time = duration
+        # Only ask Google for driving distance to the closest few by straight line
+        ambulance_data = nearest_by_haversine(user_lat, user_lng, ambulance_data, DRIVING_DISTANCE_CANDIDATES)
+
+        # Serve recently queried (user, ambulance) pairs from the cache
+        distances = []  # (distance_meters, duration_text, ambulance)
+        misses = []
+        with DISTANCE_CACHE_LOCK:
+            for ambulance in ambulance_data:
+                cached = DISTANCE_CACHE.get(distance_cache_key(user_lat, user_lng, ambulance))
+                if cached:
+                    distances.append((cached[0], cached[1], ambulance))
                 else:
-                    app.logger.warning(f"Google API invalid distance for {ambulance['id']}")
+                    misses.append(ambulance)
+
+        # Batch the remaining ambulances into as few Distance Matrix requests
+        # as possible, and issue the batches concurrently rather than one after another
+        origin = f"{user_lat},{user_lng}"
+        chunks = [
+            misses[start:start + DISTANCE_MATRIX_MAX_DESTINATIONS]
+            for start in range(0, len(misses), DISTANCE_MATRIX_MAX_DESTINATIONS)
+        ]
+        results = EXECUTOR.map(lambda chunk: fetch_distance_matrix(origin, chunk), chunks)
+
+        for chunk, data in zip(chunks, results):
+            if data.get('status') == 'OK' and data['rows']:
+                # One element per destination, in the same order as the chunk
+                for ambulance, elements in zip(chunk, data['rows'][0]['elements']):
+                    if elements['status'] == 'OK':
+                        distance = elements['distance']['value']  # meters
+                        duration = elements['duration']['text']
+                        distances.append((distance, duration, ambulance))
+                        with DISTANCE_CACHE_LOCK:
+                            DISTANCE_CACHE[distance_cache_key(user_lat, user_lng, ambulance)] = (distance, duration)
+                    else:
+                        app.logger.warning(f"Google API invalid distance for {ambulance['id']}")
             else:
                 error_msg = data.get('error_message', 'No valid distance available')
                 app.logger.error(f"Error from Distance Matrix: {error_msg}")
 
+        for distance, duration, ambulance in distances:
+            if distance < min_distance:
+                min_distance = distance
+                nearest_ambulance = ambulance
+                nearest_ambulance_time = duration
+
         if nearest_ambulance:
             # Mark 'busy'
             ambulance_id = nearest_ambulance["id"]
@@ -188,19 +333,21 @@ def fetch_route():
     }
     """
     try:
-        data = request.json
+        data = request.get_data()
         if not data:
             return jsonify({"error": "Request data missing"}), 400
 
-        ambulance_id = data.get("ambulance_id")
-        user_lat = data.get("user_lat")
-        user_lng = data.get("user_lng")
-
-        if not ambulance_id or user_lat is None or user_lng is None:
+        try:
+            req = RouteRequest.model_validate_json(data)
+        except ValidationError:
             return jsonify({"error": "Missing ambulance_id or user location"}), 400
 
+        ambulance_id = req.ambulance_id
+        user_lat = req.user_lat
+        user_lng = req.user_lng
+
         # Fetch the ambulance doc
-        amb_doc = db.collection('ambulances').document(ambulance_id).get()
+        amb_doc = db.collection('ambulances').document(ambulance_id).get(field_paths=['current_location'])
         if not amb_doc.exists:
             return jsonify({"error": "Ambulance not found"}), 404
 
@@ -220,10 +367,10 @@ def fetch_route():
             "key": GOOGLE_MAPS_API_KEY,
             "mode": "driving"
         }
-        resp = requests.get(directions_url, params=params)
-        directions_data = resp.json()
+        resp = CLIENT.get(directions_url, params=params)
+        directions_data = parse_maps_response(resp) or {}
 
-        if resp.status_code == 200 and directions_data.get("status") == "OK":
+        if directions_data.get("status") == "OK":
             route = directions_data['routes'][0]
             leg = route['legs'][0]
 
@@ -232,7 +379,7 @@ def fetch_route():
 
             # We can decode the polyline on the server or pass it to Flutter. Let's decode on the server:
             polyline_str = route['overview_polyline']['points']
-            path_coords = decode_polyline(polyline_str)  # returns [[lat, lng], [lat, lng], ...]
+            path_coords = decode_polyline(polyline_str)  # (N, 2) array of [lat, lng]
 
             return jsonify({
                 "path": path_coords,
@@ -248,41 +395,141 @@ def fetch_route():
         return jsonify({"error": str(e)}), 500
 
 
-def decode_polyline(polyline_str):
-    """Decode a polyline string into a list of [lat, lng]"""
-    points = []
-    index = 0
-    lat = 0
-    lng = 0
-    length = len(polyline_str)
-
-    while index < length:
-        shift = 0
-        result = 0
-        while True:
-            b = ord(polyline_str[index]) - 63
-            index += 1
-            result |= (b & 0x1F) << shift
-            shift += 5
-            if b < 0x20:
-                break
-        dlat = ~(result >> 1) if (result & 1) else (result >> 1)
-        lat += dlat
-
-        shift = 0
-        result = 0
-        while True:
-            b = ord(polyline_str[index]) - 63
-            index += 1
-            result |= (b & 0x1F) << shift
-            shift += 5
-            if b < 0x20:
-                break
-        dlng = ~(result >> 1) if (result & 1) else (result >> 1)
-        lng += dlng
-
-        points.append([lat / 1e5, lng / 1e5])
-    return points
+def geohash_neighborhood(lat, lng, precision):
+    """Geohash of the cell containing (lat, lng) plus its 8 neighbouring cells"""
+    center_lat, center_lng, lat_err, lng_err = pgh.decode_exactly(pgh.encode(lat, lng, precision=precision))
+    cells = set()
+    for dlat in (-2 * lat_err, 0, 2 * lat_err):
+        for dlng in (-2 * lng_err, 0, 2 * lng_err):
+            cell_lat = min(max(center_lat + dlat, -90.0), 90.0)
+            cell_lng = (center_lng + dlng + 180.0) % 360.0 - 180.0
+            cells.add(pgh.encode(cell_lat, cell_lng, precision=precision))
+    return cells
+
+
+def ambulance_record(amb):
+    """Convert an ambulance doc to the lat/lng record used for ranking, or None"""
+    get = amb.to_dict().get
+    current_location = get('current_location')
+
+    # If stored as a GeoPoint, convert to lat/lng. Firestore decodes geo values
+    # to GeoPoint itself (never a subclass), so an exact type check suffices
+    if type(current_location) is GeoPoint:
+        return {
+            "id": get('ambulance_id', 'Not available'),
+            "latitude": current_location.latitude,
+            "longitude": current_location.longitude,
+            "name": get('driver_name', 'Ambulance'),
+            "contact": get('contact_number', 'Not provided'),
+            "status": get('status', 'Not available')
+        }
+
+    app.logger.warning(f"Ambulance {amb.id} has invalid location data")
+    return None
+
+
+def stream_ambulance_records(query):
+    """Stream a query's docs, converting each one as it arrives"""
+    return [record for record in map(ambulance_record, query.stream()) if record]
+
+
+def fetch_available_ambulances(user_lat, user_lng):
+    """
+    Fetch available ambulances near the user. Uses Firestore's native
+    find_nearest when enabled, otherwise geohash range queries (when
+    USE_GEOHASH_QUERIES is set): each cell is streamed on its own worker and
+    results are collected as soon as a cell finishes. Falls back to scanning
+    every available ambulance when none are nearby or a cell query fails.
+    """
+    global find_nearest_enabled
+
+    available_ref = (
+        db.collection('ambulances')
+        .where('status', '==', 'available')
+        .select(AMBULANCE_FIELDS)
+    )
+
+    if find_nearest_enabled:
+        try:
+            ambulances = stream_ambulance_records(available_ref.find_nearest(
+                vector_field='location_vector',
+                query_vector=Vector([user_lat, user_lng]),
+                distance_measure=DistanceMeasure.EUCLIDEAN,
+                limit=FIND_NEAREST_LIMIT
+            ))
+            if ambulances:
+                return ambulances
+        except FailedPrecondition as e:
+            # The vector index hasn't been created; stop trying
+            app.logger.warning(f"find_nearest unavailable, disabling it: {str(e)}")
+            find_nearest_enabled = False
+        except GoogleAPICallError as e:
+            # Transient (deadline, unavailable, ...); fall back for this request only
+            app.logger.warning(f"find_nearest failed, falling back: {str(e)}")
+
+    ambulances = []
+    if USE_GEOHASH_QUERIES:
+        futures = [
+            EXECUTOR.submit(
+                stream_ambulance_records,
+                available_ref.where('geohash', '>=', cell).where('geohash', '<=', cell + '~')
+            )
+            for cell in geohash_neighborhood(user_lat, user_lng, GEOHASH_SEARCH_PRECISION)
+        ]
+        try:
+            for future in as_completed(futures):
+                ambulances.extend(future.result())
+        except GoogleAPICallError as e:
+            # Missing composite index (FailedPrecondition) or a transient error;
+            # stop the cells that haven't started so they don't tie up EXECUTOR
+            for future in futures:
+                future.cancel()
+            app.logger.error(f"Geohash query failed, scanning all: {str(e)}")
+            ambulances = []
+
+    if not ambulances:
+        ambulances = stream_ambulance_records(available_ref)
+    return ambulances
+
+
+def nearest_by_haversine(user_lat, user_lng, ambulances, k):
+    """Return the k ambulances closest to the user by great-circle distance"""
+    if len(ambulances) <= k:
+        return ambulances
+
+    n = len(ambulances)
+    lats = np.radians(np.fromiter((a['latitude'] for a in ambulances), dtype=np.float64, count=n))
+    lngs = np.radians(np.fromiter((a['longitude'] for a in ambulances), dtype=np.float64, count=n))
+    lat1 = np.radians(user_lat)
+    lng1 = np.radians(user_lng)
+
+    # The haversine term is monotonic in great-circle distance, so rank on it
+    # directly and skip the sqrt/arcsin/radius scaling
+    a = np.sin((lats - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lats) * np.sin((lngs - lng1) / 2) ** 2
+
+    return [ambulances[i] for i in np.argpartition(a, k)[:k]]
+
+
+def distance_cache_key(user_lat, user_lng, ambulance):
+    """Cache key for a (user, ambulance) pair at ~11 m resolution"""
+    return (
+        f"{round(user_lat, 4)},{round(user_lng, 4)}|"
+        f"{round(ambulance['latitude'], 4)},{round(ambulance['longitude'], 4)}"
+    )
+
+
+def fetch_distance_matrix(origin, ambulances):
+    """Query Distance Matrix for one origin against a batch of ambulances"""
+    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
+    params = {
+        "origins": origin,
+        "destinations": "|".join(f"{a['latitude']},{a['longitude']}" for a in ambulances),
+        "key": GOOGLE_MAPS_API_KEY,
+        "mode": "driving",
+        "departure_time": "now"
+    }
+    response = CLIENT.get(url, params=params)
+    return parse_maps_response(response) or {}
 
 
 # -------------------------------------------------------------------
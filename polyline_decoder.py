@@ -0,0 +1,63 @@
+"""Decode Google encoded polylines into (N, 2) arrays of [lat, lng]"""
+import numpy as np
+from numba import njit
+
+
+def decode_polyline(polyline_str):
+    """Decode a polyline string into an (N, 2) array of [lat, lng]"""
+    buf = np.frombuffer(polyline_str.encode('ascii'), dtype=np.uint8)
+    # Polyline characters are '?' (63) to '~' (126)
+    if buf.size and (buf.min() < 63 or buf.max() > 126):
+        raise ValueError("Invalid polyline: unexpected character")
+    return _decode_polyline(buf)
+
+
+@njit(cache=True)
+def _decode_polyline(buf):
+    """JIT-compiled polyline decoder over ASCII bytes; returns an (N, 2) array"""
+    out = np.empty((len(buf), 2), dtype=np.float64)
+    index = 0
+    k = 0
+    lat = np.int64(0)
+    lng = np.int64(0)
+    length = len(buf)
+
+    while index < length:
+        shift = 0
+        result = np.int64(0)
+        while True:
+            if index >= length:
+                raise ValueError("Invalid polyline: truncated value")
+            if shift > 30:
+                # Polyline values are 32-bit, so they never need more than 7 chunks
+                raise ValueError("Invalid polyline: value too long")
+            b = np.int64(buf[index]) - 63
+            index += 1
+            result |= (b & 0x1F) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        lat += ~(result >> 1) if (result & 1) else (result >> 1)
+
+        if index >= length:
+            raise ValueError("Invalid polyline: latitude without longitude")
+
+        shift = 0
+        result = np.int64(0)
+        while True:
+            if index >= length:
+                raise ValueError("Invalid polyline: truncated value")
+            if shift > 30:
+                raise ValueError("Invalid polyline: value too long")
+            b = np.int64(buf[index]) - 63
+            index += 1
+            result |= (b & 0x1F) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        lng += ~(result >> 1) if (result & 1) else (result >> 1)
+
+        out[k, 0] = lat / 1e5
+        out[k, 1] = lng / 1e5
+        k += 1
+    return out[:k]
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from polyline_decoder import decode_polyline
+
+
+def reference_decode(polyline_str):
+    """The original pure-Python decoder, used as the oracle"""
+    points = []
+    index = 0
+    lat = 0
+    lng = 0
+    length = len(polyline_str)
+
+    while index < length:
+        shift = 0
+        result = 0
+        while True:
+            b = ord(polyline_str[index]) - 63
+            index += 1
+            result |= (b & 0x1F) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        lat += ~(result >> 1) if (result & 1) else (result >> 1)
+
+        shift = 0
+        result = 0
+        while True:
+            b = ord(polyline_str[index]) - 63
+            index += 1
+            result |= (b & 0x1F) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        lng += ~(result >> 1) if (result & 1) else (result >> 1)
+
+        points.append([lat / 1e5, lng / 1e5])
+    return points
+
+
+def encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def test_decodes_google_example():
+    assert decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@").tolist() == [
+        [38.5, -120.2], [40.7, -120.95], [43.252, -126.453]
+    ]
+
+
+def test_empty_polyline():
+    assert decode_polyline("").tolist() == []
+
+
+def test_matches_reference_on_random_polylines():
+    rng = random.Random(0)
+    for _ in range(3000):
+        deltas = [
+            rng.choice([
+                rng.randint(-50, 50),                    # 1-2 bytes
+                rng.randint(-10 ** 6, 10 ** 6),          # up to 5 bytes
+                rng.randint(-2 ** 31 + 1, 2 ** 31 - 1),  # full 32-bit range
+            ])
+            for _ in range(2 * rng.randint(0, 60))
+        ]
+        polyline_str = "".join(encode_value(d) for d in deltas)
+        assert decode_polyline(polyline_str).tolist() == reference_decode(polyline_str)
+
+
+@pytest.mark.parametrize("polyline_str", [
+    "_",               # unterminated latitude
+    "_p~iF",           # latitude without longitude
+    "_p~iF~ps|U~",     # unterminated second point
+    "~" * 8,           # more than 7 chunks
+    "~" * 40,
+    "a b",             # character outside '?'..'~'
+])
+def test_rejects_malformed_polylines(polyline_str):
+    with pytest.raises(ValueError):
+        decode_polyline(polyline_str)